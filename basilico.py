@@ -6,6 +6,7 @@ import os
 import sys
 import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Callable, Dict, Set, List
 from pytarallo import Tarallo, Errors
 from dotenv import load_dotenv
@@ -13,10 +14,12 @@ from io import StringIO
 
 from pytarallo.Errors import ValidationError, NotAuthorizedError
 from pytarallo.ItemToUpload import ItemToUpload
+from requests.adapters import HTTPAdapter
 from twisted.internet import reactor, protocol
 from twisted.protocols.basic import LineOnlyReceiver
 import threading
 import logging
+import orjson
 from datetime import datetime
 
 from read_smartctl import extract_smart_data, smart_health_status, parse_single_disk
@@ -69,6 +72,9 @@ class Disk:
     def make_composite_id(lsblk: dict):
         return lsblk.get("path"), lsblk.get("wwn"), lsblk.get("serial")
 
+    def get_composite_id(self):
+        return self._composite_id
+
     def compare_composite_id(self, lsblk_other: dict):
         return self._composite_id == self.make_composite_id(lsblk_other)
 
@@ -112,16 +118,18 @@ class Disk:
         return changes
 
     def serialize_disk(self):
-        result = self._lsblk
-        result["code"] = self._code
-        critical = False
-        if not TEST_MODE:
-            for mountpoint in self._lsblk["mountpoint"]:
-                if mountpoint != "[SWAP]":
-                    critical = True
-                    break
-        result["has_critical_mounts"] = critical
-        return result
+        # Called without disks_lock, possibly by many threads at once: _lsblk is also changed by update_mountpoints
+        with self._update_lock:
+            result = self._lsblk
+            result["code"] = self._code
+            critical = False
+            if not TEST_MODE:
+                for mountpoint in self._lsblk["mountpoint"]:
+                    if mountpoint != "[SWAP]":
+                        critical = True
+                        break
+            result["has_critical_mounts"] = critical
+            return result
 
     def update_status(self, status: str) -> bool:
         if self._tarallo and self._code:
@@ -168,13 +176,10 @@ class Disk:
             if stop_on_error:
                 raise ErrorThatCanBeManuallyFixed(f"Disk {self._path} has no serial number")
 
-        sn = self._lsblk["serial"]
-        sn: str
-        if sn and sn.startswith("WD-"):
-            sn = sn[3:]
+        sn = self._tarallo_sn()
 
         try:
-            codes = self._tarallo.get_codes_by_feature("sn", sn)
+            codes = _resolve_code(self._tarallo, sn)
             if len(codes) <= 0:
                 self._code = None
                 logging.debug(f"Disk {sn} not found in tarallo")
@@ -227,6 +232,46 @@ class Disk:
 
     def set_code(self, code: str):
         self._code = code
+        # The cached lookup for this serial is stale now
+        if "serial" in self._lsblk:
+            _forget_code(self._tarallo_sn())
+
+    def _tarallo_sn(self) -> Optional[str]:
+        sn = self._lsblk["serial"]
+        sn: str
+        if sn and sn.startswith("WD-"):
+            sn = sn[3:]
+        return sn
+
+
+def _resolve_code(tarallo: Tarallo.Tarallo, sn: str) -> tuple:
+    now = time.monotonic()
+    with tarallo_codes_cache_lock:
+        cached = tarallo_codes_cache.get(sn)
+        if cached is not None:
+            if now - cached[0] < CODE_CACHE_TTL:
+                return cached[1]
+            del tarallo_codes_cache[sn]
+        epoch = tarallo_codes_cache_epoch
+    # Exceptions are not cached, failed lookups are retried next time
+    codes = tuple(tarallo.get_codes_by_feature("sn", sn) or ())
+    with tarallo_codes_cache_lock:
+        # If something was invalidated meanwhile, this result may be stale already
+        if epoch == tarallo_codes_cache_epoch:
+            # Oldest entries come first
+            for old_sn, (timestamp, _) in list(tarallo_codes_cache.items()):
+                if now - timestamp < CODE_CACHE_TTL and len(tarallo_codes_cache) < CODE_CACHE_SIZE:
+                    break
+                del tarallo_codes_cache[old_sn]
+            tarallo_codes_cache[sn] = (now, codes)
+    return codes
+
+
+def _forget_code(sn: Optional[str]):
+    global tarallo_codes_cache_epoch
+    with tarallo_codes_cache_lock:
+        tarallo_codes_cache.pop(sn, None)
+        tarallo_codes_cache_epoch += 1
 
 
 class ErrorThatCanBeManuallyFixed(BaseException):
@@ -308,6 +353,7 @@ class CommandRunner(threading.Thread):
                     running_commands.remove(self)
                 except KeyError:
                     pass
+                running_commands_cv.notify_all()
 
     def stop_asap(self):
         # This is completely pointless unless the command checks self._go
@@ -357,7 +403,7 @@ class CommandRunner(threading.Thread):
     @staticmethod
     def dev_from_args(args: str):
         # This may be more complicated for some future commands
-        return args.split(" ", 1)[0]
+        return args.partition(" ")[0]
 
     def list_iso(self, cmd: str, iso_dir: str):
         files = []
@@ -583,11 +629,8 @@ class CommandRunner(threading.Thread):
         reactor.callFromThread(reactor.callLater, CLOSE_AT_END_TIMER, try_stop_at_end)
 
     def cannolo(self, _cmd: str, dev_and_iso: str):
-        parts: list[Optional[str]] = dev_and_iso.split(" ", 1)
-        while len(parts) < 2:
-            parts.append(None)
-        dev, iso = parts
-        if iso is None:
+        dev, sep, iso = dev_and_iso.partition(" ")
+        if not sep:
             self._queued_command.notify_finish_with_error(f"No iso selected")
             return
 
@@ -630,7 +673,7 @@ class CommandRunner(threading.Thread):
             if success:
                 partition = ""
                 print(f"dev: {dev}")  # Added print statement for testing
-                result = subprocess.run(["lsblk --exclude 7 -J -o PTTYPE,NAME"], capture_output=True, text=True)
+                result = subprocess.run(["lsblk", "--exclude", "7", "-J", "-o", "PTTYPE,NAME"], capture_output=True, text=True)
                 if result.returncode == 0:
                     lsblk_output = json.loads(result.stdout)
                     for device in lsblk_output.get("blockdevices", []):
@@ -770,17 +813,48 @@ class CommandRunner(threading.Thread):
         if params:
             self.send_msg(cmd, params)
 
-    def _get_smartctl(self, dev: str, queued: bool):
+    def _get_smartctl(self, dev: str, queued: bool, use_cache: bool = True):
         if queued:
             self._queued_command.notify_start("Getting smarter")
-        pipe = subprocess.Popen(
-            ("sudo", "-n", "smartctl", "-j", "-a", dev),
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-        )
-        output = pipe.stdout.read().decode("utf-8")
-        stderr = pipe.stderr.read().decode("utf-8")
-        exitcode = pipe.wait()
+        # smartctl -a is slow and hard on the disk, reuse recent results if clients ask again.
+        # The key includes the serial number, so a different disk in the same bay is not mistaken for the old one:
+        # look at what is in the bay right now, not at the last scan.
+        cache_key = None
+        if queued:
+            # The status is uploaded to tarallo for this disk later, refresh only once
+            with disks_lock:
+                update_disks_if_needed(self)
+                disk_ref = disks[dev]
+            cache_key = disk_ref.get_composite_id()
+        elif dev in disks:
+            try:
+                for lsblk in get_disks(dev):
+                    if lsblk.get("path") == dev:
+                        cache_key = Disk.make_composite_id(lsblk)
+                        break
+            except json.JSONDecodeError:
+                # lsblk printed nothing, the disk is gone: do not use the cache, smartctl will report the error
+                pass
+        cached = None
+        if cache_key:
+            with smartctl_cache_lock:
+                cached = smartctl_cache.get(cache_key)
+        from_cache = use_cache and cached is not None and time.monotonic() - cached[0] < SMARTCTL_CACHE_TTL
+        if from_cache:
+            _, output, stderr, exitcode = cached
+        else:
+            # Each disk has its own thread already, this only caps how many smartctl run at the same time
+            with smartctl_semaphore:
+                pipe = subprocess.Popen(
+                    ("sudo", "-n", "smartctl", "-j", "-a", dev),
+                    stderr=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                # Reading one pipe to the end before the other could block forever if the other fills up
+                output_bytes, stderr_bytes = pipe.communicate()
+                exitcode = pipe.returncode
+            output = output_bytes.decode("utf-8", "replace")
+            stderr = stderr_bytes.decode("utf-8", "replace")
 
         if exitcode == 0:
             smartctl_returned_valid = True
@@ -792,6 +866,10 @@ class CommandRunner(threading.Thread):
                 # TODO: parse remaining bits (https://github.com/WEEE-Open/pesto/issues/65)
                 smartctl_returned_valid = True
 
+        if smartctl_returned_valid and cache_key and not from_cache:
+            with smartctl_cache_lock:
+                smartctl_cache[cache_key] = (time.monotonic(), output, stderr, exitcode)
+
         updated = False
         status = None
 
@@ -823,12 +901,9 @@ class CommandRunner(threading.Thread):
         if queued and status:
             self._queued_command.notify_percentage(50.0, "Updating tarallo if needed")
 
-            with disks_lock:
-                update_disks_if_needed(self)
-                disk_ref = disks[dev]
-
             # noinspection PyBroadException
             try:
+                # noinspection PyUnboundLocalVariable
                 updated = disk_ref.update_status(status)
             except BaseException as e:
                 self._queued_command.notify_error("Error during upload")
@@ -873,7 +948,8 @@ class CommandRunner(threading.Thread):
         #     "output": output,
         #     "stderr": stderr,
         # }
-        smartctl = self._get_smartctl(dev, False)
+        # This creates the item on tarallo, always read fresh data
+        smartctl = self._get_smartctl(dev, False, use_cache=False)
 
         if queued:
             self._queued_command.notify_percentage(50.0, "smartctl output obtained")
@@ -890,9 +966,8 @@ class CommandRunner(threading.Thread):
         if queued:
             self._queued_command.notify_percentage(75.0, "Parsing done")
 
-        with disks_lock:
-            # update_disks_if_needed(self)
-            disk_ref = disks[dev]
+        # update_disks_if_needed(self)
+        disk_ref = disks[dev]
 
         try:
             code = disk_ref.create_on_tarallo(features, loc)
@@ -933,8 +1008,13 @@ class CommandRunner(threading.Thread):
             self._queued_command.notify_finish("Upload done")
 
     @staticmethod
-    def _encode_param(param):
-        return json.dumps(param, separators=(",", ":"), indent=None)
+    def _encode_param(param) -> bytes:
+        try:
+            return orjson.dumps(param)
+        except orjson.JSONEncodeError as e:
+            # orjson refuses some values that json accepts, e.g. file names that are not valid UTF-8
+            logging.debug(f"orjson could not encode a message, falling back to json: {str(e)}")
+            return json.dumps(param, separators=(",", ":"), indent=None).encode("utf-8")
 
     def send_msg(self, cmd: str, param=None, the_id: Optional[int] = None):
         logging.debug(f"[{self._the_id}] Sending {cmd}{ ' with args' if param else ''} to client")
@@ -947,23 +1027,27 @@ class CommandRunner(threading.Thread):
             # noinspection PyBroadException
             try:
                 if param is None:
-                    response_string = cmd
+                    response = cmd.encode("utf-8")
                 else:
                     j_param = self._encode_param(param)
-                    response_string = f"{cmd} {j_param}"
+                    response = cmd.encode("utf-8") + b" " + j_param
                 # It's there but pycharm doesn't believe it
                 # noinspection PyUnresolvedReferences
-                reactor.callFromThread(TurboProtocol.send_msg, thread, response_string)
+                reactor.callFromThread(TurboProtocol.send_msg, thread, response)
             except BaseException:
                 logging.warning(f"[{the_id}] Something blew up while trying to send {cmd} (connection already closed?)")
 
     def get_disks(self, cmd: str, _nothing: str):
         result = []
-        with disks_lock:
-            # Sent regardless
-            update_disks_if_needed(self, False)
-            for disk in disks:
-                result.append(disks[disk].serialize_disk())
+        # If another thread is refreshing already, send the current list instead of waiting for it
+        if disks_lock.acquire(blocking=False):
+            try:
+                # Sent regardless
+                update_disks_if_needed(self, False)
+            finally:
+                disks_lock.release()
+        for disk in disks.values():
+            result.append(disk.serialize_disk())
         self.send_msg(cmd, result)
 
     @staticmethod
@@ -1221,24 +1305,26 @@ class TurboProtocol(LineOnlyReceiver):
             logging.debug(f"[{str(self._id)}] Client sent exit, closing connection")
             self.transport.loseConnection()
         else:
-            parts = line.split(" ", 1)
-            cmd = parts[0].lower()
-            args = parts[1] if len(parts) > 1 else ""
+            cmd, _, args = line.partition(" ")
+            cmd = cmd.lower()
 
             # Create the thread. It will enqueue and/or start itself.
             CommandRunner(cmd, args, self._id)
 
-    def send_msg(self, response: str):
+    def send_msg(self, response: bytes):
         if self._delimiter_found:
-            self.sendLine(response.encode("utf-8"))
+            self.sendLine(response)
         else:
-            logging.warning(f"[{str(self._id)}] Cannot send command to client due to unknown delimiter: {response}")
+            logging.warning(f"[{str(self._id)}] Cannot send command to client due to unknown delimiter: {response.decode('utf-8')}")
 
 
 def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = True):  # , disk: Optional[str] = None):
+    global disks
     with disks_lock:
         disks_lsblk = get_disks()
         found_disks = set()
+        # Copy on write: readers keep using the old dict, without locking, until the new one is ready
+        new_disks = dict(disks)
 
         changes = False
         for lsblk in disks_lsblk:
@@ -1251,10 +1337,10 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
 
             found_disks.add(path)
             add = False
-            if path in disks:
-                if disks[path].compare_composite_id(lsblk):
+            if path in new_disks:
+                if new_disks[path].compare_composite_id(lsblk):
                     try:
-                        more_changes = disks[path].update_from_tarallo_if_needed()
+                        more_changes = new_disks[path].update_from_tarallo_if_needed()
                         changes = changes or more_changes
                     except ErrorThatCanBeManuallyFixed as e:
                         if this_thread:
@@ -1265,7 +1351,8 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
 
                 else:
                     logging.info(f"Disk {path} has changed")
-                    del disks[path]
+                    del new_disks[path]
+                    forget_smartctl(path)
                     add = True
             else:
                 logging.info(f"Disk {path} is new")
@@ -1273,15 +1360,14 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
             if add:
                 # noinspection PyBroadException
                 try:
-                    global TARALLO
-                    disks[path] = Disk(lsblk, TARALLO)
+                    new_disks[path] = Disk(lsblk, tarallo_for_disk())
                     changes = True
                 except BaseException as e:
                     logging.warning("Exception while re-scanning for disks, skipping", exc_info=e)
 
         # RuntimeError: dictionary changed size during iteration
         to_delete = []
-        for path in disks:
+        for path in new_disks:
             if path in found_disks:
                 continue
             else:
@@ -1289,34 +1375,51 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
                 to_delete.append(path)
 
         for path in to_delete:
-            del disks[path]
+            del new_disks[path]
+            forget_smartctl(path)
             changes = True
 
-        if send and changes and this_thread:
-            result = []
-            with disks_lock:
-                for disk in disks:
-                    result.append(disks[disk].serialize_disk())
-            this_thread.send_msg("get_disks", result)
+        disks = new_disks
+
+    if send and changes and this_thread:
+        result = []
+        for disk in disks.values():
+            result.append(disk.serialize_disk())
+        this_thread.send_msg("get_disks", result)
+
+
+def forget_smartctl(path: str):
+    with smartctl_cache_lock:
+        for key in [key for key in smartctl_cache if key[0] == path]:
+            del smartctl_cache[key]
 
 
 def scan_for_disks():
+    global disks
     with disks_lock:
         logging.debug("Scanning for disks")
         disks_lsblk = get_disks()
-        for disk_lsblk in disks_lsblk:
-            path = disk_lsblk.get("path")
-            if path:
-                path = str(disk_lsblk["path"])
-            else:
-                logging.warning("Disk has no path, ignoring: " + disk_lsblk)
-                continue
-            # noinspection PyBroadException
-            try:
-                global TARALLO
-                disks[path] = Disk(disk_lsblk, TARALLO)
-            except BaseException as e:
-                logging.warning("Exception while scanning for disks, skipping", exc_info=e)
+        new_disks = dict(disks)
+        # Each Disk does a blocking tarallo lookup, build them in parallel
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            futures = {}
+            for disk_lsblk in disks_lsblk:
+                path = disk_lsblk.get("path")
+                if path:
+                    path = str(disk_lsblk["path"])
+                else:
+                    logging.warning("Disk has no path, ignoring: " + disk_lsblk)
+                    continue
+                futures[path] = pool.submit(Disk, disk_lsblk, tarallo_for_disk())
+
+            # Collect in lsblk order, so disks are listed the same way as before
+            for path, future in futures.items():
+                # noinspection PyBroadException
+                try:
+                    new_disks[path] = future.result()
+                except BaseException as e:
+                    logging.warning("Exception while scanning for disks, skipping", exc_info=e)
+        disks = new_disks
 
 
 def get_disks(path: Optional[str] = None):
@@ -1362,12 +1465,12 @@ def main():
         print("KeyboardInterrupt, terminating")
     finally:
         # TODO: reactor has already stopped here, but threads may send messages... what happens? A big crash, right?
-        while len(running_commands) > 0:
-            with running_commands_lock:
-                thread_to_stop = next(iter(running_commands))
-            thread_to_stop: CommandRunner
-            thread_to_stop.stop_asap()
-            thread_to_stop.join()
+        with running_commands_cv:
+            while running_commands:
+                # Commands may have started while waiting, stop them too
+                for thread_to_stop in running_commands:
+                    thread_to_stop.stop_asap()
+                running_commands_cv.wait()
 
 
 def load_settings():
@@ -1386,12 +1489,36 @@ def load_settings():
         global CLOSE_AT_END_TIMER
         CLOSE_AT_END_TIMER = int(os.getenv("CLOSE_AT_END_TIMER"))
 
+    if os.getenv("SMARTCTL_CACHE_TTL") is not None:
+        global SMARTCTL_CACHE_TTL
+        SMARTCTL_CACHE_TTL = int(os.getenv("SMARTCTL_CACHE_TTL"))
+
     url = os.getenv("TARALLO_URL") or logging.warning("TARALLO_URL is not set, tarallo will be unavailable")
     token = os.getenv("TARALLO_TOKEN") or logging.warning("TARALLO_TOKEN is not set, tarallo will be unavailable")
 
     if url and token:
-        global TARALLO
-        TARALLO = Tarallo.Tarallo(url, token)
+        global TARALLO, TARALLO_ADAPTER
+        # pytarallo already reuses a requests.Session, but its default pool keeps only 10 connections around,
+        # less than the threads that may talk to tarallo at once: the others would reconnect every time
+        TARALLO_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        TARALLO = new_tarallo_client(url, token)
+
+
+def new_tarallo_client(url: str, token: str) -> Tarallo.Tarallo:
+    tarallo = Tarallo.Tarallo(url, token)
+    # noinspection PyUnresolvedReferences
+    session = tarallo._Tarallo__session
+    session.mount("https://", TARALLO_ADAPTER)
+    session.mount("http://", TARALLO_ADAPTER)
+    return tarallo
+
+
+def tarallo_for_disk() -> Optional[Tarallo.Tarallo]:
+    # pytarallo keeps the last response on the instance, so threads must not share one.
+    # Each Disk gets its own client, all of them use the same connection pool.
+    if TARALLO is None:
+        return None
+    return new_tarallo_client(TARALLO.url, TARALLO.token)
 
 
 def get_smartctl_status(smartctl_output: str) -> Optional[str]:
@@ -1408,13 +1535,14 @@ def get_smartctl_status(smartctl_output: str) -> Optional[str]:
 
 def find_mounts(el: dict):
     mounts = {}
-    if el["mountpoint"] is not None:
-        mounts[el["path"]] = el["mountpoint"]
-    if "children" in el:
-        children = el["children"]
-        for child in children:
-            children_mounts = find_mounts(child)
-            mounts = {**mounts, **children_mounts}
+    stack = [el]
+    while stack:
+        node = stack.pop()
+        if node["mountpoint"] is not None:
+            mounts[node["path"]] = node["mountpoint"]
+        if "children" in node:
+            # Reversed, so they are popped (and listed) in the same order as lsblk prints them
+            stack.extend(reversed(node["children"]))
     return mounts
 
 
@@ -1423,7 +1551,10 @@ def get_disks_linux(path: Optional[str] = None) -> list:
     # To filter out ODDs and tape drives: --exclude 9,11
     # See: https://www.kernel.org/doc/Documentation/admin-guide/devices.txt
     # Also: https://unix.stackexchange.com/a/610634
-    output = subprocess.getoutput(f"lsblk --exclude 9,11 -b -o NAME,PATH,VENDOR,MODEL,SERIAL,HOTPLUG,ROTA,MOUNTPOINT,SIZE -J {path if path else ''}")
+    command = ["lsblk", "--exclude", "9,11", "-b", "-o", "NAME,PATH,VENDOR,MODEL,SERIAL,HOTPLUG,ROTA,MOUNTPOINT,SIZE", "-J"]
+    if path:
+        command.append(path)
+    output = subprocess.run(command, capture_output=True, text=True).stdout
     jsonized = json.loads(output)
     if "blockdevices" in jsonized:
         result = jsonized["blockdevices"]
@@ -1452,8 +1583,8 @@ def try_stop_at_end():
                     with running_commands_lock:
                         if len(running_commands) <= 0:
                             empty = True
-                            for path in disks:
-                                empty = disks[path].queue_is_empty()
+                            for disk in disks.values():
+                                empty = disk.queue_is_empty()
                                 if not empty:
                                     break
                             if empty:
@@ -1492,9 +1623,14 @@ def run_command_on_partition(dev: str, cmd: str) -> bool:
 
 
 TARALLO = None
+TARALLO_ADAPTER = None
 CLOSE_AT_END = False
 CLOSE_AT_END_LOCK = threading.Lock()
 CLOSE_AT_END_TIMER = 5
+SMARTCTL_MAX_PARALLEL = 8
+CODE_CACHE_TTL = 60
+CODE_CACHE_SIZE = 1024
+SMARTCTL_CACHE_TTL = 30
 
 clients: Dict[int, TurboProtocol] = {}
 clients_lock = threading.Lock()
@@ -1504,10 +1640,21 @@ disks_lock = threading.RLock()
 
 running_commands: Set[CommandRunner] = set()
 running_commands_lock = threading.Lock()
+running_commands_cv = threading.Condition(running_commands_lock)
 
 queued_commands: List[QueuedCommand] = []
 queued_commands_lock = threading.Lock()
 
+smartctl_semaphore = threading.BoundedSemaphore(SMARTCTL_MAX_PARALLEL)
+# Serial number to (time.monotonic() of the lookup, codes)
+tarallo_codes_cache: Dict[str, tuple] = {}
+tarallo_codes_cache_lock = threading.Lock()
+# Incremented on every invalidation, lookups that were running meanwhile are not stored
+tarallo_codes_cache_epoch = 0
+# Disk composite id (path, wwn, serial) to (time.monotonic() of the run, output, stderr, exitcode)
+smartctl_cache: Dict[tuple, tuple] = {}
+smartctl_cache_lock = threading.Lock()
+
 
 if __name__ == "__main__":
     load_settings()
@@ -37,8 +37,10 @@ def get_files(paths, quiet: bool, predict: bool):
     for file in paths:
         file: str
         if os.path.isdir(file):
-            for filename in os.listdir(file):
-                filenames.append(file.rstrip("/") + "/" + filename)
+            with os.scandir(file) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        filenames.append(entry.path)
         elif os.path.isfile(file):
             filenames.append(file)
         else:
@@ -71,29 +73,22 @@ def get_files(paths, quiet: bool, predict: bool):
         print(f"Merging {len(already_labeled)} old labels")
         results += list(already_labeled.values())
 
-    header = []
-    header_set = set()
-    for result in results:
-        for k in result:
-            if k != "Status" and k not in header_set:
-                header_set.add(k)
-                header.append(k)
-    header_set.add("Status")
+    # dict keeps insertion order, so this is the order in which keys are first seen
+    header = list(dict.fromkeys(k for result in results for k in result if k != "Status"))
     header.append("Status")
     print(header)
 
-    with open("labeled.csv", "w", newline="") as csvfile:
+    with open("labeled.csv", "w", newline="", buffering=1024 * 1024) as csvfile:
         writer = csv.DictWriter(
             csvfile,
             delimiter=",",
             quotechar='"',
             quoting=csv.QUOTE_MINIMAL,
             fieldnames=header,
+            extrasaction="ignore",
         )
         writer.writeheader()
-
-        for result in results:
-            writer.writerow(result)
+        writer.writerows(results)
 
     print(f"Predictions: {predictions['right']} good, {predictions['wrong']} bad, {predictions['failed']} errors")
     acc = float(predictions["right"]) / (float(predictions["right"]) + float(predictions["wrong"])) * 100
@@ -115,12 +110,13 @@ def parse_file(
 ):
     print(f"File {counter} - {filename}")
 
-    with open(filename, "r") as f:
-        try:
-            found = parse_smartctl_output(f)
-            found_at_least_one = True
-        except RuntimeError:
-            found_at_least_one = False
+    with open(filename, "rb") as f:
+        output = f.read().decode("utf-8", "replace")
+    try:
+        found = parse_smartctl_output(output)
+        found_at_least_one = True
+    except RuntimeError:
+        found_at_least_one = False
 
     prediction = None
     if predict:
@@ -154,27 +150,34 @@ def parse_file(
         return
 
     if not quiet or not found["Notsmart_Serial_Number"] in already_labeled:
+        power_on_details = ""
+        if "Power_On_Hours" in found:
+            # noinspection PyBroadException
+            try:
+                hours = int(found["Power_On_Hours"])
+                server = hours / 24 / 365
+                office = hours / 8 / 304
+                power_on_details = f" ({server:.2f} server years, {office:.2f} office years)"
+                if server >= 20:
+                    power_on_details += f" (or, if minutes, {server/60:.2f} server years, {office/60:.2f} office years)"
+            except BaseException:
+                pass
+
+        ignored = ("Notsmart_Serial_Number", "Notsmart_Rotation_Rate")
+        lines = []
         for k in found:
             details = ""
             if k == "Total_LBAs_Written":
                 details = f" ({int(found[k])*512/1024/1024/1024:.2f} GiB)"
             elif k == "Power_On_Hours":
-                # noinspection PyBroadException
-                try:
-                    server = int(found[k]) / 24 / 365
-                    office = int(found[k]) / 8 / 304
-                    details = f" ({server:.2f} server years, {office:.2f} office years)"
-                    if server >= 20:
-                        details += f" (or, if minutes, {server/60:.2f} server years, {office/60:.2f} office years)"
-                except BaseException:
-                    pass
-            ignored = ("Notsmart_Serial_Number", "Notsmart_Rotation_Rate")
-            if found[k].isnumeric() and int(found[k]) != 0 and k not in ignored:
+                details = power_on_details
+            if k not in ignored and found[k].isnumeric() and int(found[k]) != 0:
                 color1 = RED
                 color2 = END_ESCAPE
             else:
                 color1 = color2 = ""
-            print(f"{k}: {color1}{found[k]}{color2}{details}")
+            lines.append(f"{k}: {color1}{found[k]}{color2}{details}")
+        print("\n".join(lines))
 
     answered = False
     question = "Is it OK, SUS, OLD, FAIL or discard? [K,S,O,F,X] "